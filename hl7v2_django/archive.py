@@ -0,0 +1,295 @@
+"""
+    archive.py
+
+    Append-only archive of the raw frames passing through the MLLP server.
+
+    Frames are buffered in memory and written out in batches. Each batch
+    is compressed into a single gzip member which is appended to a
+    segment file. Segments are partitioned by hour:
+
+        <root>/<YYYYMMDD>/<HH>.seg.gz   compressed frames
+        <root>/<YYYYMMDD>/<HH>.idx      index, one line per frame
+
+    Each index line is tab separated:
+
+        timestamp direction sender message_type control_id patient_id
+        member_offset member_length offset length
+
+    sender is MSH-3, message_type MSH-9, control_id MSH-10 and patient_id
+    the first identifier in PID-3, stored as UTF-8 (bytes that are not
+    valid UTF-8 are replaced, the frame itself is archived unchanged). direction is 'I' for inbound and 'O'
+    for outbound frames. member_offset is the position of the gzip member
+    in the segment file, member_length its uncompressed size and
+    offset/length locate the frame within the uncompressed member.
+
+    The files are opened with O_APPEND and every batch is written with a
+    single write, so several processes can archive into the same segment.
+    Because each batch is a complete gzip member, "zcat" on a segment
+    shows its frames.
+"""
+
+import os
+import gzip
+import time
+import logging
+from cStringIO import StringIO
+
+logger = logging.getLogger(__name__)
+
+INBOUND = 'I'
+OUTBOUND = 'O'
+
+SEGMENT_SUFFIX = '.seg.gz'
+INDEX_SUFFIX = '.idx'
+
+CR = '\r'
+FIELD_SEP = '|'
+
+
+def partition(timestamp):
+    """The partition (day directory, hour) a timestamp is archived under"""
+    date = time.localtime(timestamp)
+    return time.strftime('%Y%m%d', date), time.strftime('%H', date)
+
+
+def _clean(value):
+    """Index values must be UTF-8 and not contain the index separators"""
+    value = value.decode('utf-8', 'replace').encode('utf-8')
+    return value.replace('\t', ' ').replace('\n', ' ').replace(CR, ' ')
+
+
+def index_fields(frame):
+    """
+        Extract (sender, message_type, control_id, patient_id) from a raw
+        frame. This is deliberately cheap, it does not parse the message.
+    """
+    sender = message_type = control_id = patient_id = ''
+    for segment in frame.split(CR):
+        if segment.startswith('MSH'):
+            fields = segment.split(FIELD_SEP)
+            fields += [''] * (10 - len(fields))
+            sender, message_type, control_id = fields[2], fields[8], fields[9]
+        elif segment.startswith('PID'):
+            fields = segment.split(FIELD_SEP)
+            if len(fields) > 3:
+                # first repetition, first component (ID number)
+                patient_id = fields[3].split('~')[0].split('^')[0]
+            break
+    return _clean(sender), _clean(message_type), _clean(control_id), _clean(patient_id)
+
+
+def _append(path, data):
+    """
+        Append data to a file in a single write, return the file offset
+        it was written at.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:])
+        return os.lseek(fd, 0, os.SEEK_CUR) - len(data)
+    finally:
+        os.close(fd)
+
+
+class ArchiveEntry(object):
+    """A single archived frame, as described by its index line"""
+
+    __slots__ = ('timestamp', 'direction', 'sender', 'message_type',
+        'control_id', 'patient_id', 'segment', 'member_offset',
+        'member_length', 'offset', 'length')
+
+    def __init__(self, segment, fields):
+        """fields is an index line split on tabs"""
+        self.segment = segment
+        self.timestamp = float(fields[0])
+        (self.direction, self.sender, self.message_type, self.control_id,
+            self.patient_id) = [f.decode('utf-8', 'replace') for f in fields[1:6]]
+        (self.member_offset, self.member_length, self.offset,
+            self.length) = [int(f) for f in fields[6:10]]
+
+    def __str__(self):
+        return 'ArchiveEntry(%s, %s, %s, %s, %s, %s)' % (
+            time.strftime('%Y%m%d%H%M%S', time.localtime(self.timestamp)),
+            self.direction, self.sender, self.message_type, self.control_id,
+            self.patient_id)
+
+
+class ArchiveWriter(object):
+    """
+        Buffer frames and write them out in batches.
+
+        record() only appends to a list. The frames are written when the
+        batch is full, or by flush_if_due() once flush_interval seconds
+        have passed since the first buffered frame. The server calls
+        flush_if_due() every time it wakes up.
+    """
+
+    def __init__(self, root, batch_size=100, flush_interval=1.0, compresslevel=6):
+        self.root = root
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.compresslevel = compresslevel
+        self.pending = []
+        self.oldest = None
+
+    def record(self, direction, frame, timestamp=None):
+        now = time.time()
+        if timestamp is None:
+            timestamp = now
+        if not self.pending:
+            self.oldest = now
+        self.pending.append((timestamp, direction, frame))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush_if_due(self):
+        if self.pending and time.time() - self.oldest >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write all pending frames, one gzip member per partition"""
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        batches = {}
+        order = []
+        for item in pending:
+            key = partition(item[0])
+            if key not in batches:
+                batches[key] = []
+                order.append(key)
+            batches[key].append(item)
+        for key in order:
+            try:
+                self._write_batch(key, batches[key])
+            except (IOError, OSError):
+                logger.exception('Unable to archive %d frames to %s',
+                    len(batches[key]), os.path.join(self.root, *key))
+
+    def _write_batch(self, key, batch):
+        day, hour = key
+        directory = os.path.join(self.root, day)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+        entries = []
+        raw = StringIO()
+        offset = 0
+        for timestamp, direction, frame in batch:
+            raw.write(frame)
+            raw.write('\n')
+            entries.append((timestamp, direction, index_fields(frame), offset, len(frame)))
+            offset += len(frame) + 1
+        raw = raw.getvalue()
+
+        member = StringIO()
+        gz = gzip.GzipFile(filename='', mode='wb', fileobj=member,
+            compresslevel=self.compresslevel)
+        gz.write(raw)
+        gz.close()
+
+        member_offset = _append(os.path.join(directory, hour + SEGMENT_SUFFIX),
+            member.getvalue())
+        index = ['%.6f\t%s\t%s\t%s\t%s\t%s\t%d\t%d\t%d\t%d\n' % ((timestamp, direction)
+            + fields + (member_offset, len(raw), offset, length))
+            for timestamp, direction, fields, offset, length in entries]
+        _append(os.path.join(directory, hour + INDEX_SUFFIX), ''.join(index))
+
+
+class Archive(object):
+    """
+        Query the archive. Only the index files of the partitions in the
+        requested time range are read; segments are only opened when a
+        frame is read.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._member_key = None
+        self._member = None
+
+    def partitions(self, start=None, end=None):
+        """(day, hour) partitions overlapping start - end, in order"""
+        if not os.path.isdir(self.root):
+            return
+        first = start is not None and partition(start) or None
+        last = end is not None and partition(end) or None
+        for day in sorted(os.listdir(self.root)):
+            if first and day < first[0] or last and day > last[0]:
+                continue
+            directory = os.path.join(self.root, day)
+            if not os.path.isdir(directory):
+                continue
+            hours = [name[:-len(INDEX_SUFFIX)] for name in os.listdir(directory)
+                if name.endswith(INDEX_SUFFIX)]
+            for hour in sorted(hours):
+                if first and (day, hour) < first or last and (day, hour) > last:
+                    continue
+                yield day, hour
+
+    def query(self, start=None, end=None, direction=None, sender=None,
+            message_type=None, control_id=None, patient_id=None):
+        """
+            Yield an ArchiveEntry for each archived frame matching all
+            of the given criteria, in the order they were archived.
+            start and end are unix timestamps.
+
+            Lines are matched on their raw fields; an ArchiveEntry is
+            only built for the lines that match.
+        """
+        # (index column, UTF-8 value)
+        criteria = [(column, isinstance(value, unicode) and value.encode('utf-8') or value)
+            for column, value in [
+            (1, direction), (2, sender), (3, message_type), (4, control_id),
+            (5, patient_id)] if value is not None]
+        # The most selective value, to skip most lines without splitting them
+        needle = criteria and max([value for column, value in criteria], key=len) or None
+        for day, hour in self.partitions(start, end):
+            base = os.path.join(self.root, day, hour)
+            segment = base + SEGMENT_SUFFIX
+            with open(base + INDEX_SUFFIX, 'rb') as index:
+                for line in index:
+                    if not line.endswith('\n'):
+                        break   # partially written
+                    if needle and needle not in line:
+                        continue
+                    fields = line[:-1].split('\t')
+                    for column, value in criteria:
+                        if fields[column] != value:
+                            break
+                    else:
+                        if start is not None or end is not None:
+                            timestamp = float(fields[0])
+                            if start is not None and timestamp < start:
+                                continue
+                            if end is not None and timestamp > end:
+                                continue
+                        yield ArchiveEntry(segment, fields)
+
+    def read(self, entry):
+        """Return the raw frame for an entry"""
+        key = (entry.segment, entry.member_offset)
+        if key != self._member_key:
+            # Frames are read in archive order, so keep the last member
+            with open(entry.segment, 'rb') as f:
+                f.seek(entry.member_offset)
+                gz = gzip.GzipFile(fileobj=f, mode='rb')
+                self._member = gz.read(entry.member_length)
+            self._member_key = key
+        return self._member[entry.offset:entry.offset + entry.length]
+
+
+def get_writer(config):
+    """Build an ArchiveWriter from the HL7_ARCHIVE setting, None if disabled"""
+    if not config:
+        return None
+    return ArchiveWriter(config['root'],
+        batch_size=config.get('batch_size', 100),
+        flush_interval=config.get('flush_interval', 1.0),
+        compresslevel=config.get('compresslevel', 6))
@@ -0,0 +1,70 @@
+"""
+    client.py
+
+    A minimal blocking MLLP client. Used by the mllpload command to put
+    load on runmllpyserver.
+"""
+
+import math
+import socket
+
+from hl7v2_django.management.commands.runmllpyserver import LLP_SB, LLP_EB, CR, BLKSIZE
+
+
+class MLLPClient(object):
+    def __init__(self, host, port, timeout=30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = ''
+
+    def connect(self):
+        self.close()
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.buffer = ''
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def send(self, message):
+        """Send a message, return the response frame"""
+        if self.sock is None:
+            self.connect()
+        if not message.endswith(CR):
+            message += CR
+        self.sock.sendall(LLP_SB + message + LLP_EB + CR)
+        return self.receive()
+
+    def receive(self):
+        """Read one frame, return its content"""
+        while LLP_EB not in self.buffer:
+            data = self.sock.recv(BLKSIZE)
+            if not data:
+                self.close()
+                raise socket.error('Connection closed by server')
+            self.buffer += data
+        frame, self.buffer = self.buffer.split(LLP_EB, 1)
+        self.buffer = self.buffer.lstrip(CR)
+        return frame[frame.find(LLP_SB) + 1:]
+
+
+def ack_code(response):
+    """MSA-1 of a response frame, '' if there is none"""
+    for segment in response.split(CR):
+        if segment.startswith('MSA'):
+            fields = segment.split('|')
+            if len(fields) > 1:
+                return fields[1]
+    return ''
+
+
+def percentile(values, pct):
+    """The pct percentile of a list of numbers (nearest rank)"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
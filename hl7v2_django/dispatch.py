@@ -12,6 +12,7 @@ from django.utils.importlib import import_module
 from django.db import transaction
 
 from hl7v2_django import responses
+from hl7v2_django import tracing
 
 
 class pattern(object):
@@ -36,11 +37,19 @@ class pattern(object):
     def __str__(self):
         return 'Pattern(%s, %s, %s)' % (self.regex_str, self.view, self.kwargs)
 
-    def callback(self, request, args, kwargs):
+    def resolve(self):
+        """Import the view if not already done, return it"""
         if self._view is None:
             self._view = get_callable(self.view)
+        return self._view
+
+    def callback(self, request, args, kwargs):
+        view = self.resolve()
         with transaction.commit_on_success():
-            return self._view(request, *args, **kwargs)
+            resp = view(request, *args, **kwargs)
+            tracing.mark('handler')
+        tracing.mark('commit')
+        return resp
 
 
 class Dispatcher(object):
@@ -48,6 +57,14 @@ class Dispatcher(object):
         root = settings.ROOT_HL7_DISPATCH_CONFIG
         self.root = getattr(import_module(root), 'rules')
 
+    def resolve(self):
+        """
+            Import all the views now, rather than on the first message,
+            so that errors in the handlers are found at startup.
+        """
+        for pattern in self.root:
+            pattern.resolve()
+
     def dispatch(self, request):
         path = '%s/%s/%s' % (unicode(request['MSH'][0][8]),
             request['MSH'][0][4], request['MSH'][0][5])
@@ -61,6 +78,7 @@ class Dispatcher(object):
                     args = match.groups()
                 # In both cases, pass any extra_kwargs as **kwargs.
                 kwargs.update(pattern.kwargs)
+                tracing.mark('route')
                 return pattern.callback(request, args, kwargs)
 
         return responses.hl7NAK('AE', 'No handler configured to handle request %s, app %s, facility %s' % 
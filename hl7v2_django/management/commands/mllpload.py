@@ -0,0 +1,122 @@
+"""
+    Load generator for runmllpyserver.
+
+    Each client thread opens a connection and sends its messages one at a
+    time, waiting for the response before sending the next. If the
+    connection fails before a response arrives the message is resent on
+    a new connection, as an interface engine would. A message is lost if
+    no response is received after --retries attempts.
+
+    To check a reload, run this against the server and send the server
+    SIGHUP while it runs; lost should be 0.
+"""
+
+import os
+import time
+import socket
+import threading
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from hl7v2_django import responses
+from hl7v2_django.client import MLLPClient, ack_code, percentile
+
+
+MESSAGE = '\r'.join([
+    r'MSH|^~\&|MLLPLOAD|LOAD|||%(timestamp)s||%(message_type)s|%(control_id)s|P|2.4',
+    r'PID|1||%(control_id)s^^^LOAD||Load^Test',
+    ]) + '\r'
+
+
+class LoadClient(threading.Thread):
+    def __init__(self, number, host, port, messages, message_type, retries):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.number = number
+        self.client = MLLPClient(host, port)
+        self.messages = messages
+        self.message_type = message_type
+        self.retries = retries
+        self.latencies = []
+        self.codes = {}
+        self.resent = 0
+        self.lost = 0
+
+    def run(self):
+        for i in range(self.messages):
+            message = MESSAGE % {
+                'timestamp': responses.timestamp(),
+                'message_type': self.message_type,
+                'control_id': 'LOAD%d.%d.%d' % (os.getpid(), self.number, i),
+                }
+            for attempt in range(self.retries):
+                if attempt:
+                    self.resent += 1
+                start = time.time()
+                try:
+                    response = self.client.send(message)
+                except socket.error:
+                    self.client.close()
+                    time.sleep(0.1 * attempt)
+                    continue
+                self.latencies.append(time.time() - start)
+                code = ack_code(response)
+                self.codes[code] = self.codes.get(code, 0) + 1
+                break
+            else:
+                self.lost += 1
+        self.client.close()
+
+
+class Command(BaseCommand):
+    args = ''
+    help = """Send HL7 messages to a MLLP server and report throughput.
+
+        Usage:\n\n\tdjango [options] mllpload --clients 10 --messages 1000
+        """
+    option_list = BaseCommand.option_list + (
+        make_option('--host', dest='host', default='127.0.0.1',
+            help='Server host (default 127.0.0.1)'),
+        make_option('--port', dest='port', type='int', default=None,
+            help='Server port (default the first of settings.MLLP_SOCKETS)'),
+        make_option('--clients', dest='clients', type='int', default=10,
+            help='Number of concurrent connections (default 10)'),
+        make_option('--messages', dest='messages', type='int', default=1000,
+            help='Messages sent by each client (default 1000)'),
+        make_option('--type', dest='message_type', default='ADT^A01',
+            help='Message type, MSH-9 (default ADT^A01)'),
+        make_option('--retries', dest='retries', type='int', default=5,
+            help='Attempts per message before it is counted as lost (default 5)'),
+        )
+
+    def handle(self, *args, **options):
+        port = options['port']
+        if port is None:
+            port = int(settings.MLLP_SOCKETS[0]['recv_addr'].split(':')[-1])
+        clients = [LoadClient(n, options['host'], port, options['messages'],
+            options['message_type'], options['retries']) for n in range(options['clients'])]
+
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            while client.is_alive():
+                client.join(1)
+        elapsed = time.time() - start
+
+        latencies = []
+        codes = {}
+        for client in clients:
+            latencies.extend(client.latencies)
+            for code, count in client.codes.items():
+                codes[code] = codes.get(code, 0) + count
+        sent = options['clients'] * options['messages']
+        self.stdout.write('sent %d, responses %d, resent %d, lost %d\n' % (sent,
+            len(latencies), sum([c.resent for c in clients]), sum([c.lost for c in clients])))
+        self.stdout.write('ack codes %s\n' % ', '.join(['%s: %d' % (code or '-', count)
+            for code, count in sorted(codes.items())]))
+        self.stdout.write('%.1f messages/second, latency p50 %.1fms, p99 %.1fms, max %.1fms\n' % (
+            len(latencies) / elapsed, percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000, max(latencies or [0]) * 1000))
@@ -0,0 +1,124 @@
+"""
+    Replay archived inbound messages through the Dispatcher.
+
+    The messages are selected from the archive configured in
+    settings.HL7_ARCHIVE and dispatched in the order they were received,
+    at no more than --rate messages per second.
+"""
+
+import time
+import logging
+from optparse import make_option
+
+import hl7
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from hl7v2_django import archive
+from hl7v2_django.dispatch import Dispatcher
+
+
+logger = logging.getLogger(__name__)
+
+# Formats accepted for --start and --end by length, with the index into
+# a time tuple of their last part: the day, hour, minute or second.
+# strptime alone is ambiguous, '%Y%m%d%H%M%S' accepts 2011120112.
+FORMATS = {
+    8: ('%Y%m%d', 2),
+    10: ('%Y%m%d%H', 3),
+    12: ('%Y%m%d%H%M', 4),
+    14: ('%Y%m%d%H%M%S', 5),
+}
+
+
+def parse_timestamp(value, end=False):
+    """
+        HL7 style YYYYMMDD[HH[MM[SS]]] local time to a unix timestamp.
+        The start of the period given, or its last microsecond if end is
+        true, so that --end 2011120112 includes all of hour 12.
+    """
+    value = value.strip()
+    if len(value) in FORMATS:
+        fmt, last = FORMATS[len(value)]
+        try:
+            parsed = list(time.strptime(value, fmt))
+        except ValueError:
+            pass
+        else:
+            if not end:
+                return time.mktime(tuple(parsed))
+            # The start of the next period; mktime normalises the overflow
+            # and works out daylight saving for the -1
+            parsed[last] += 1
+            parsed[8] = -1
+            return time.mktime(tuple(parsed)) - 0.000001
+    raise CommandError('Invalid time %r, expected YYYYMMDD[HH[MM[SS]]]' % value)
+
+
+class Command(BaseCommand):
+    args = ''
+    help = """Replay archived inbound HL7 messages through the dispatcher.
+
+        Usage:\n\n\tdjango [options] replayhl7archive --start 20111201 --end 2011120112 --type MFN^M02
+        """
+    option_list = BaseCommand.option_list + (
+        make_option('--start', dest='start', default=None,
+            help='Replay messages received from this time, YYYYMMDD[HH[MM[SS]]]'),
+        make_option('--end', dest='end', default=None,
+            help='Replay messages received up to the end of this time, YYYYMMDD[HH[MM[SS]]]'),
+        make_option('--sender', dest='sender', default=None,
+            help='Only messages from this sending application (MSH-3)'),
+        make_option('--type', dest='message_type', default=None,
+            help='Only messages of this type (MSH-9), e.g. MFN^M02'),
+        make_option('--control-id', dest='control_id', default=None,
+            help='Only the message with this control id (MSH-10)'),
+        make_option('--patient-id', dest='patient_id', default=None,
+            help='Only messages for this patient (PID-3)'),
+        make_option('--rate', dest='rate', type='float', default=10.0,
+            help='Maximum messages per second, 0 for no limit (default 10)'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='List the selected messages without dispatching them'),
+        )
+
+    def handle(self, *args, **options):
+        config = getattr(settings, 'HL7_ARCHIVE', None)
+        if not config:
+            raise CommandError('settings.HL7_ARCHIVE is not configured')
+        store = archive.Archive(config['root'])
+
+        start = options['start'] and parse_timestamp(options['start']) or None
+        end = options['end'] and parse_timestamp(options['end'], end=True) or None
+        entries = store.query(start=start, end=end, direction=archive.INBOUND,
+            sender=options['sender'], message_type=options['message_type'],
+            control_id=options['control_id'], patient_id=options['patient_id'])
+
+        dispatcher = None
+        if not options['dry_run']:
+            dispatcher = Dispatcher()
+        rate = options['rate']
+        begin = time.time()
+        count = 0
+        for entry in entries:
+            if dispatcher is None:
+                self.stdout.write('%s\n' % entry)
+                count += 1
+                continue
+            if rate > 0:
+                delay = begin + count / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            count += 1
+            try:
+                frame = store.read(entry).decode('utf-8')
+                resp = dispatcher.dispatch(hl7.parse(frame))
+                if resp is None:
+                    self.stdout.write('%s -> no response\n' % entry)
+                    continue
+                # Segments of a built message cannot be found by name
+                msa = hl7.parse(unicode(resp))['MSA'][0]
+                self.stdout.write('%s -> %s %s\n' % (entry, msa[1], msa[3]))
+            except Exception:
+                logger.exception('Error replaying %s', entry)
+        self.stdout.write('%d messages %s\n' % (count,
+            dispatcher is None and 'selected' or 'replayed'))
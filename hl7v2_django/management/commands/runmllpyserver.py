@@ -3,10 +3,24 @@
     process, Bytes are wrapped in a frame using frame characters. 
     The content of the frame is limited to printable ascii characters 
     and the carriage return.
+
+    The command runs as a supervisor which owns the listening sockets
+    and forks a worker process to serve them. On SIGHUP a new worker is
+    forked, which loads the dispatch config and handler modules afresh.
+    Once it is ready, the old worker is sent SIGTERM and drains: it stops
+    accepting, finishes the frames it has read, closes its connections
+    as they go idle and exits. The listening sockets are shared by the
+    workers, so they are never closed and connections queue up in the
+    backlog while the workers change over.
 """ 
 
 
 
+import os
+import time
+import errno
+import fcntl
+import signal
 import socket
 import select
 import logging
@@ -15,10 +29,12 @@ import pdb
 
 import hl7
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 
 from hl7v2_django import responses
+from hl7v2_django import archive
+from hl7v2_django import tracing
 from hl7v2_django.dispatch import Dispatcher
 
 
@@ -36,16 +52,49 @@ CR = chr(0xD)
 
 BLKSIZE=8192
 
+DRAIN_TIMEOUT = 30          # seconds a draining worker waits for its connections
+DRAIN_IDLE = 1.0            # seconds a connection must be idle before it is closed
+DRAIN_CLOSE_RATE = 50       # idle connections closed per second while draining
+WORKER_START_TIMEOUT = 60   # seconds a new worker has to load its handlers
+
+def wait_for(pid):
+    """Wait for a child process to exit, ignoring interruptions"""
+    while True:
+        try:
+            return os.waitpid(pid, 0)
+        except OSError, e:
+            if e.errno == errno.ECHILD:
+                return pid, 0
+            if e.errno != errno.EINTR:
+                raise
+
+
 class LLPServer(object):
-    def __init__(self, config):
+    def __init__(self, config, sockets=None, drain_timeout=DRAIN_TIMEOUT, tracer=None):
+        """
+            sockets are listening sockets, one per config entry, made
+            by _mk_socket. If not given they are created here.
+
+            tracer is a tracing.Tracer, if messages are to be timed.
+        """
 
         # Initialise the sockets - we are listening on them both
         self.epoll = select.epoll()
         self.recv_sock = []       # Sockets we are listening on
         self.recv_fileno = []     # filenos for these sockets
         self.mllp_ack = []        # mllp ack for these sockets
-        for c in config:
-            recv_sock = self._mk_socket(c['recv_addr'])
+        self.draining = False
+        self.drain_timeout = drain_timeout
+        self.tracer = tracer
+        # drain() writes to this pipe to wake up the poll
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        fcntl.fcntl(self.wakeup_w, fcntl.F_SETFL, os.O_NONBLOCK)
+        self.epoll.register(self.wakeup_r, select.EPOLLIN)
+        for i, c in enumerate(config):
+            if sockets:
+                recv_sock = sockets[i]
+            else:
+                recv_sock = self._mk_socket(c['recv_addr'])
             self.ack = c.get('mllp_ack')
             logger.info('Listening for RECV ON %s', c['recv_addr'])
             recv_fileno = recv_sock.fileno()
@@ -54,10 +103,14 @@ class LLPServer(object):
             self.recv_fileno.append(recv_fileno)
             self.mllp_ack.append(c.get('mllp_ack', False))
 
-    def _mk_socket(self, addr):
+    @staticmethod
+    def _mk_socket(addr):
         """
             Set up the socket as per:
             http://scotdoyle.com/python-epoll-howto.html
+
+            The backlog is as large as the system allows, so that senders
+            reconnecting during a reload are queued rather than refused.
         """
         if addr.find(':') != -1:
             host, port = addr.split(':', 1)
@@ -68,7 +121,7 @@ class LLPServer(object):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((host, port))
-        s.listen(5)
+        s.listen(socket.SOMAXCONN)
         s.setblocking(0)
         return(s)
 
@@ -128,45 +181,168 @@ class LLPServer(object):
             sent += bytes
         return sent
 
-    def dispatch(self, recv_handler):
+    def close(self):
+        """
+            Release the epoll, the wakeup pipe and the listening sockets,
+            once dispatch has returned. A worker does not need this, its
+            copies are closed when it exits.
+        """
+        self.epoll.close()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+        for sock in self.recv_sock:
+            sock.close()
+
+    def drain(self):
+        """
+            Stop accepting connections and return from dispatch once the
+            open connections are closed. Safe to call from a signal
+            handler.
+        """
+        self.draining = True
+        try:
+            os.write(self.wakeup_w, 'D')
+        except OSError:
+            pass    # pipe full, a wakeup is already pending
+
+    def dispatch(self, recv_handler, idle_handler=None):
         """ 
             Receive messages, pass them to handler
+
+            idle_handler, if given, is called every time the server
+            wakes up, at least every poll delay. It may return the most
+            seconds the server should wait before calling it again.
+
+            Returns when draining is complete. Frames are handled to
+            completion, so between polls no connection is part way
+            through a message. While draining, a connection is closed
+            when it has been idle for DRAIN_IDLE or once it has been sent
+            a response, so nothing is lost; the sender reconnects to the
+            new worker.
         """
         recv_connections = {}
         ack_connections = {}
+        last_active = {}
+        drain_started = None
+        # Connections closed while draining, and allowed to be closed so far
+        counts = {'closed': 0, 'allowed': 0}
+        wait = None     # from idle_handler
+
+        def close(fileno):
+            self.epoll.unregister(fileno)
+            recv_connections.pop(fileno).close()
+            ack_connections.pop(fileno, None)
+            last_active.pop(fileno, None)
+
+        def serve(fileno):
+            """Read a frame from a connection and handle it"""
+            last_active[fileno] = time.time()
+            if self.tracer:
+                self.tracer.begin()
+            try:
+                frame = self._read_frame(recv_connections[fileno])
+                tracing.mark('read')
+                if frame in [LLP_NAK, LLP_ACK]:
+                    logger.debug('ACK recieved from recv socket: %s', frame.replace(CR, '\n'))
+                elif frame is None:
+                    close(fileno)
+                    logger.debug('Closing recv socket')
+                else:
+                    recv_handler(frame, self, recv_connections[fileno])
+                    if ack_connections[fileno]:
+                        self._write_ack(recv_connections[fileno])
+                    last_active[fileno] = time.time()
+            finally:
+                if self.tracer:
+                    self.tracer.end()
+            if frame not in [None, LLP_NAK, LLP_ACK]:
+                if self.draining and counts['closed'] < counts['allowed']:
+                    close(fileno)
+                    counts['closed'] += 1
+
+        def waiting(fileno):
+            """True if a connection has data that has not been read"""
+            try:
+                return recv_connections[fileno].recv(1, socket.MSG_PEEK) != ''
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
 
         while True:
             delay = 5
-            events = self.epoll.poll(delay)
+            if self.draining:
+                now = time.time()
+                if drain_started is None:
+                    drain_started = now
+                    for fileno in self.recv_fileno:
+                        self.epoll.unregister(fileno)
+                    logger.info('Draining %d connections', len(recv_connections))
+                if now - drain_started > self.drain_timeout:
+                    logger.warning('Drain timeout, closing %d connections', len(recv_connections))
+                    for fileno in recv_connections.keys():
+                        close(fileno)
+                if not recv_connections:
+                    logger.info('Drained')
+                    return
+                # Connections are closed a few at a time, so the senders
+                # do not all reconnect at once
+                counts['allowed'] = int((now - drain_started) * DRAIN_CLOSE_RATE) + 1
+                delay = 0.1
+            if wait is not None:
+                delay = min(delay, wait)
+
+            try:
+                events = self.epoll.poll(delay)
+            except IOError, e:
+                # interrupted by a signal
+                if e.errno != errno.EINTR:
+                    raise
+                events = []
+            if idle_handler:
+                wait = idle_handler()
             for fileno, event in events:
-                if fileno in self.recv_fileno:
+                if fileno == self.wakeup_r:
+                    os.read(self.wakeup_r, BLKSIZE)
+                elif fileno in self.recv_fileno:
+                    if self.draining:
+                        continue
                     recv_sock = self.recv_sock[self.recv_fileno.index(fileno)]
                     mllp_ack = self.mllp_ack[self.recv_fileno.index(fileno)]
-                    connection, address = recv_sock.accept()
+                    try:
+                        connection, address = recv_sock.accept()
+                    except socket.error, e:
+                        # Another worker sharing the socket accepted it
+                        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            continue
+                        raise
                     recv_connections[connection.fileno()] = connection
                     ack_connections[connection.fileno()] = mllp_ack
+                    last_active[connection.fileno()] = time.time()
                     self.epoll.register(connection.fileno(), select.EPOLLIN)
                     connection.setblocking(0)
                 elif event & select.EPOLLIN:
                     if fileno in recv_connections:
-                        frame = self._read_frame(recv_connections[fileno])
-                        if frame in [LLP_NAK, LLP_ACK]:
-                            logger.debug('ACK recieved from recv socket: %s', frame.replace(CR, '\n'))
-                        elif frame is None:
-                            self.epoll.unregister(fileno)
-                            recv_connections[fileno].close()
-                            del recv_connections[fileno]
-                            logger.debug('Closing recv socket')
-                        else:
-                            recv_handler(frame, self, recv_connections[fileno])
-                            if ack_connections[fileno]:
-                                self._write_ack(recv_connections[fileno])
+                        serve(fileno)
                 elif event & select.EPOLLHUP:
                     logger.debug('EVENT: EPOLLHUP')
-                    self.epoll.unregister(fileno)
                     if fileno in recv_connections:
-                        recv_connections[fileno].close()
-                        del recv_connections[fileno]
+                        close(fileno)
+                    else:
+                        self.epoll.unregister(fileno)
+
+            if drain_started is not None:
+                # Close idle connections. A frame can arrive after the poll,
+                # while another connection is being served, so a connection
+                # with data waiting is served rather than closed.
+                now = time.time()
+                for fileno in recv_connections.keys():
+                    if counts['closed'] < counts['allowed'] and now - last_active[fileno] >= DRAIN_IDLE:
+                        if waiting(fileno):
+                            serve(fileno)
+                        else:
+                            close(fileno)
+                            counts['closed'] += 1
 
 
 class Command(BaseCommand):
@@ -175,7 +351,12 @@ class Command(BaseCommand):
 
         Usage:\n\n\tdjango [options] runmllpserver [--pdb] 
 
-        --pdb for postmortem debugger
+        --pdb for postmortem debugger, runs in a single process
+        --slow=SECONDS log the timing of messages slower than this
+        --profile=SECONDS profile for this long on SIGUSR2
+
+        SIGHUP reloads the dispatch config and handlers without dropping
+        connections, SIGTERM drains the connections and exits.
         """ 
     option_list = BaseCommand.option_list + (
         make_option('--pdb',
@@ -183,26 +364,218 @@ class Command(BaseCommand):
             dest='postmortem',
             default=False,
             help='Post mortem debugger on error'),
+        make_option('--slow',
+            type='float',
+            dest='slow_threshold',
+            default=None,
+            help='Log a timing breakdown of messages taking longer than this many seconds'),
+        make_option('--profile',
+            type='int',
+            dest='profile',
+            default=None,
+            help='On SIGUSR2, profile the worker for this many seconds and log the stats'),
         )
 
     postmortem = False
+    archive = None
+    tracer = None
+    profiler = None
+
+    reload_requested = False
+    stop_requested = False
 
     def handle(self, *args, **options):
         config = settings.MLLP_SOCKETS
-        server = LLPServer(config)
-        self.dispatcher = Dispatcher()
+        slow_threshold = options['slow_threshold']
+        if slow_threshold is None:
+            slow_threshold = getattr(settings, 'HL7_SLOW_MESSAGE_THRESHOLD', None)
+        if slow_threshold is not None:
+            self.tracer = tracing.Tracer(slow_threshold)
+        if options['profile']:
+            self.profiler = tracing.Profiler(options['profile'],
+                getattr(settings, 'HL7_PROFILE_DIR', None))
         if options['postmortem']:
+            # Single process, so the debugger keeps the terminal
             try:
                 self.postmortem = True
-                server.dispatch(self.recv_handler)
+                self.run_worker(config)
             except:
                 pdb.post_mortem()
                 raise
         else:
-            server.dispatch(self.recv_handler)
+            self.supervise(config)
 
+    def run_worker(self, config, sockets=None, ready=None):
+        """
+            Serve the sockets until drained. The dispatch config and
+            handlers are loaded here, in the worker, so that a reload
+            picks up new code. ready is a pipe written to once the
+            handlers are loaded.
+        """
+        server = LLPServer(config, sockets,
+            drain_timeout=getattr(settings, 'MLLP_DRAIN_TIMEOUT', DRAIN_TIMEOUT),
+            tracer=self.tracer)
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.drain())
+        if self.profiler:
+            signal.signal(signal.SIGUSR2, lambda signum, frame: self.profiler.request())
+            logger.info('Send SIGUSR2 to %d to profile for %d seconds',
+                os.getpid(), self.profiler.duration)
+        else:
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+        self.dispatcher = Dispatcher()
+        self.dispatcher.resolve()
+        self.archive = archive.get_writer(getattr(settings, 'HL7_ARCHIVE', None))
+        if ready is not None:
+            os.write(ready, 'R')
+            os.close(ready)
+        try:
+            server.dispatch(self.recv_handler, self.idle_handler)
+        finally:
+            if self.archive:
+                self.archive.flush()
+
+    def spawn_worker(self, config, sockets):
+        """Fork a worker, return its pid once it is ready, None if it failed"""
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+            status = 0
+            try:
+                self.run_worker(config, sockets, w)
+            except:
+                logger.exception('Worker %d failed', os.getpid())
+                status = 1
+            os._exit(status)
+
+        os.close(w)
+        ready = ''
+        deadline = time.time() + WORKER_START_TIMEOUT
+        try:
+            while not ready and time.time() < deadline:
+                try:
+                    readable = select.select([r], [], [], deadline - time.time())[0]
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    continue
+                if not readable:
+                    break
+                ready = os.read(r, 1)
+                if not ready:
+                    break   # worker exited
+        finally:
+            os.close(r)
+        if ready:
+            logger.info('Worker %d started', pid)
+            return pid
+        logger.error('Worker %d failed to start', pid)
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+        wait_for(pid)
+        return None
+
+    def supervise(self, config, sockets=None):
+        """
+            Own the listening sockets and keep a worker serving them.
+            SIGHUP replaces the worker, SIGTERM or SIGINT drains it and
+            exits. SIGUSR2 is passed on to the worker.
+
+            sockets are as for LLPServer, created here if not given.
+        """
+        if not sockets:
+            sockets = [LLPServer._mk_socket(c['recv_addr']) for c in config]
+        worker = None
+
+        def reload_handler(signum, frame):
+            self.reload_requested = True
+
+        def stop_handler(signum, frame):
+            self.stop_requested = True
+
+        def profile_handler(signum, frame):
+            if worker is not None:
+                os.kill(worker, signal.SIGUSR2)
+
+        signal.signal(signal.SIGUSR2, profile_handler)
+        signal.signal(signal.SIGHUP, reload_handler)
+        signal.signal(signal.SIGTERM, stop_handler)
+        signal.signal(signal.SIGINT, stop_handler)
+
+        worker = self.spawn_worker(config, sockets)
+        if worker is None:
+            raise CommandError('Unable to start worker')
+        draining = set()
+        while True:
+            while True:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except OSError:
+                    break
+                if pid == 0:
+                    break
+                if pid in draining:
+                    logger.info('Worker %d finished draining', pid)
+                    draining.discard(pid)
+                elif pid == worker:
+                    logger.error('Worker %d exited with status %d', pid, status)
+                    worker = None
+
+            if self.stop_requested:
+                break
+            if worker is None:
+                worker = self.spawn_worker(config, sockets)
+            elif self.reload_requested:
+                self.reload_requested = False
+                logger.info('Reloading')
+                new_worker = self.spawn_worker(config, sockets)
+                if new_worker is None:
+                    logger.error('Reload failed, worker %d continues', worker)
+                else:
+                    try:
+                        os.kill(worker, signal.SIGTERM)
+                        draining.add(worker)
+                    except OSError:
+                        pass
+                    worker = new_worker
+            time.sleep(1)
+
+        logger.info('Stopping')
+        if worker is not None:
+            draining.add(worker)
+        for pid in draining:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in draining:
+            wait_for(pid)
+
+    def idle_handler(self):
+        if self.archive:
+            self.archive.flush_if_due()
+        if self.profiler:
+            self.profiler.poll()
+            return self.profiler.remaining()
+
+    def send_response(self, server, connection, resp):
+        logger.debug('SEND: %s', unicode(resp).replace(CR, '\n'))
+        frame = unicode(resp).encode('utf-8')
+        tracing.mark('serialize')
+        if self.archive:
+            self.archive.record(archive.OUTBOUND, frame)
+        server._write_frame(connection, frame)
+        tracing.mark('write')
 
     def recv_handler(self, msg, server, connection):
+        if self.archive:
+            self.archive.record(archive.INBOUND, msg)
         msg = msg.decode('utf-8')
         logger.debug('RECV: %s', msg.replace(CR, '\n'))
         # Logic here - parse the message HL7
@@ -211,29 +584,28 @@ class Command(BaseCommand):
         # If enhanced mode, do the requisite steps to store then ack 
         try:
             msg = hl7.parse(msg)
+            tracing.mark('parse')
         except:
             logger.exception('Error parsing message')
             if self.postmortem:
                 pdb.post_mortem()
             resp = responses.hl7NAK('AE', 'UNABLE TO PARSE REQUEST')
-            logger.debug('SEND: %s', unicode(resp).replace(CR, '\n'))
-            server._write_frame(connection, unicode(resp).encode('utf-8'))
+            self.send_response(server, connection, resp)
             return
 
         try:
+            tracing.annotate(msg)
             # DISPATCH MESSAGE HERE. Expect an acknowledgement response message - 
             resp = self.dispatcher.dispatch(msg)
             if resp is None:
                 raise Exception('Application returned and invalid response (None) - response required')
-            logger.debug('SEND: %s', unicode(resp).replace(CR, '\n'))
-            server._write_frame(connection, unicode(resp).encode('utf-8'))
+            self.send_response(server, connection, resp)
             return
         except:
             logger.exception('Error dispatching message')
             if self.postmortem:
                 pdb.post_mortem()
             resp = responses.hl7NAK('AE', 'INTERNAL ERROR PROCESSING REQUEST')
-            logger.debug('SEND: %s', unicode(resp).replace(CR, '\n'))
-            server._write_frame(connection, unicode(resp).encode('utf-8'))
+            self.send_response(server, connection, resp)
             return
 
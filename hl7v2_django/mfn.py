@@ -0,0 +1,316 @@
+"""
+    mfn.py
+
+    Master File Notification (MFN) processing (Chapter 8).
+
+    A MFN message has a MFI segment identifying the master file, then a
+    group per record: a MFE segment (event, control id, effective date,
+    primary key) followed by the segments holding the record, e.g. STF
+    and PRA for staff and practitioners.
+
+    MasterFile applies all the records in a message to a model in bulk:
+
+        MAD, MUP    add/update - the record is upserted
+        MDL         delete
+        MDC, MAC    deactivate/reactivate - the active field of the row
+                    is set by key, other segments are ignored
+
+    MDL, MDC and MAC records fail if there is no row with their key.
+
+    The existing rows for the keys in the message are loaded in one query
+    into an index of key -> field values. Records identical to their row
+    are skipped, new ones are inserted with bulk_create and changed ones
+    updated by key with one UPDATE ... CASE statement per chunk of rows,
+    without loading or saving model instances. Deletes are a DELETE per
+    chunk of keys, so no delete signals are sent and nothing cascades.
+
+    The response is a MFK message with a MFA segment per record giving
+    its result.
+"""
+
+import logging
+
+import hl7
+
+from django.db import connections, router, transaction
+
+from hl7v2_django import responses
+from hl7v2_django.responses import SEP
+
+logger = logging.getLogger(__name__)
+
+# MFE-1 record-level event codes (HL7 table 0180)
+MAD = 'MAD'     # add
+MUP = 'MUP'     # update
+MDL = 'MDL'     # delete
+MDC = 'MDC'     # deactivate
+MAC = 'MAC'     # reactivate
+
+# MFA-4 record-level error return (HL7 table 0181)
+SUCCESS = 'S'
+FAILURE = 'U'
+
+# Query parameters per statement, within the SQLite limit of 999
+CHUNK_SIZE = 500
+
+
+def value(segment, field, component=0):
+    """A component of a field as unicode, u'' if not present"""
+    try:
+        return segment[field][component]
+    except (IndexError, TypeError):
+        return u''
+
+
+def chunks(items, size=CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class MFNRecord(object):
+    """One MFE group of a MFN message"""
+
+    def __init__(self, mfe):
+        self.mfe = mfe
+        self.event = value(mfe, 1)
+        self.control_id = value(mfe, 2)
+        self.effective = value(mfe, 3)
+        self.key = value(mfe, 4)
+        self.segments = {}
+        self.status = SUCCESS
+        self.error = ''
+
+    def segment(self, name):
+        """The first segment of this record with the given name, or None"""
+        return self.segments.get(name)
+
+    def fail(self, error):
+        self.status = FAILURE
+        self.error = error
+
+
+def parse(request):
+    """Split a MFN message into its MFI segment and a list of MFNRecords"""
+    mfi = None
+    records = []
+    for segment in request:
+        name = value(segment, 0)
+        if name == 'MFI':
+            mfi = segment
+        elif name == 'MFE':
+            records.append(MFNRecord(segment))
+        elif records:
+            records[-1].segments.setdefault(name, segment)
+    return mfi, records
+
+
+class MasterFile(object):
+    """
+        Apply MFN messages to a model. Subclasses set model, key_field
+        (the model field holding the MFE-4 primary key) and implement
+        fields() to map a record to the other model field values.
+    """
+    model = None
+    key_field = 'key'
+    active_field = 'active'     # set by MDC/MAC, None if not supported
+    message_type = ['MFK', 'M01']
+
+    def fields(self, record):
+        """
+            Return a dict of model field values for a MAD/MUP record.
+            Raise ValueError if the record is invalid.
+        """
+        raise NotImplementedError
+
+    def process(self, request):
+        mfi, records = parse(request)
+        if mfi is None:
+            return responses.hl7ACK(request, 'AE', 'No MFI segment',
+                message_type=self.message_type)
+
+        # Final state per key, later records in the message win
+        upserts = {}
+        activations = {}    # key -> (active, record)
+        deletes = {}        # key -> (record, added earlier in the message)
+        for record in records:
+            key = record.key
+            if not key:
+                record.fail('No primary key (MFE-4)')
+            elif record.event == MDL:
+                added = upserts.pop(key, None) is not None or key in deletes
+                activations.pop(key, None)
+                deletes[key] = (record, added)
+            elif record.event in (MAD, MUP):
+                try:
+                    upserts[key] = self.fields(record)
+                except ValueError, e:
+                    record.fail(unicode(e))
+                    continue
+                activations.pop(key, None)
+                deletes.pop(key, None)
+            elif record.event in (MDC, MAC):
+                active = record.event == MAC
+                if self.active_field is None:
+                    record.fail('%s not supported' % record.event)
+                elif key in deletes:
+                    record.fail('Deleted earlier in this message')
+                elif key in upserts:
+                    upserts[key][self.active_field] = active
+                else:
+                    activations[key] = (active, record)
+            else:
+                record.fail('Unknown event %s' % record.event)
+
+        created, updated, unchanged = self.upsert(upserts)
+        updated += self.activate(activations)
+        deleted = self.delete(deletes)
+        logger.info('%s: %d records, %d created, %d updated, %d unchanged, %d deleted',
+            self.model.__name__, len(records), created, updated, unchanged, deleted)
+        return self.acknowledge(request, mfi, records)
+
+    def index(self, keys, names):
+        """key -> tuple of field values, for the rows with these keys"""
+        index = {}
+        manager = self.model._default_manager
+        for chunk in chunks(keys):
+            rows = manager.filter(**{self.key_field + '__in': chunk}).values_list(
+                self.key_field, *names)
+            for row in rows:
+                index[row[0]] = tuple(row[1:])
+        return index
+
+    def upsert(self, upserts):
+        if not upserts:
+            return 0, 0, 0
+        names = sorted(upserts.values()[0].keys())
+        keys = sorted(upserts)
+        existing = self.index(keys, names)
+        manager = self.model._default_manager
+
+        create = []
+        update = []
+        unchanged = 0
+        for key in keys:
+            values = upserts[key]
+            if key not in existing:
+                values[self.key_field] = key
+                create.append(self.model(**values))
+            elif existing[key] != tuple([values[name] for name in names]):
+                update.append((key, values))
+            else:
+                unchanged += 1
+
+        for chunk in chunks(create):
+            manager.bulk_create(chunk)
+        # Each row takes a key and value per column, plus a key
+        for chunk in chunks(update, CHUNK_SIZE // (2 * len(names) + 1)):
+            self.update(chunk, names)
+        return len(create), len(update), unchanged
+
+    def update(self, rows, names):
+        """
+            Update a list of (key, values) rows in one statement:
+
+            UPDATE table SET name = CASE key WHEN %s THEN %s ... END, ...
+            WHERE key IN (...)
+
+            SQLite and MySQL convert each value to the column's type. Other
+            databases, e.g. PostgreSQL, type a CASE of untyped parameters
+            as text, so the values are cast to the column type.
+        """
+        db = router.db_for_write(self.model)
+        connection = connections[db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        key_column = qn(opts.get_field(self.key_field).column)
+        typed = connection.vendor not in ('sqlite', 'mysql')
+        assignments = []
+        params = []
+        for name in names:
+            field = opts.get_field(name)
+            then = typed and 'CAST(%%s AS %s)' % field.db_type(connection=connection) or '%s'
+            assignments.append('%s = CASE %s %s END' % (qn(field.column), key_column,
+                ' '.join(['WHEN %s THEN ' + then] * len(rows))))
+            for key, values in rows:
+                params.extend([key, field.get_db_prep_save(values[name], connection=connection)])
+        params.extend([key for key, values in rows])
+        sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (qn(opts.db_table),
+            ', '.join(assignments), key_column, ', '.join(['%s'] * len(rows)))
+        connection.cursor().execute(sql, params)
+        transaction.commit_unless_managed(using=db)
+
+    def activate(self, activations):
+        """
+            Set the active field of existing rows by key, one UPDATE per
+            chunk of keys for each value. Records for unknown keys fail.
+        """
+        if not activations:
+            return 0
+        keys = sorted(activations)
+        manager = self.model._default_manager
+        current = {}
+        for chunk in chunks(keys):
+            current.update(manager.filter(**{self.key_field + '__in': chunk}).values_list(
+                self.key_field, self.active_field))
+        changes = {True: [], False: []}
+        for key in keys:
+            active, record = activations[key]
+            if key not in current:
+                record.fail('No record with key %s' % key)
+            elif bool(current[key]) != active:
+                changes[active].append(key)
+        for active, changed in changes.items():
+            for chunk in chunks(changed):
+                manager.filter(**{self.key_field + '__in': chunk}).update(
+                    **{self.active_field: active})
+        return len(changes[True]) + len(changes[False])
+
+    def delete(self, deletes):
+        """
+            Delete the rows for a dict of key -> (record, added), return
+            the number deleted. Records for unknown keys fail, unless
+            the key was added earlier in the message.
+        """
+        if not deletes:
+            return 0
+        existing = self.index(sorted(deletes), [])
+        keys = []
+        for key in sorted(deletes):
+            record, added = deletes[key]
+            if key in existing:
+                keys.append(key)
+            elif not added:
+                record.fail('No record with key %s' % key)
+        if not keys:
+            return 0
+        db = router.db_for_write(self.model)
+        connection = connections[db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        cursor = connection.cursor()
+        deleted = 0
+        for chunk in chunks(keys):
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (qn(opts.db_table),
+                qn(opts.get_field(self.key_field).column), ', '.join(['%s'] * len(chunk))),
+                chunk)
+            deleted += cursor.rowcount
+        transaction.commit_unless_managed(using=db)
+        return deleted
+
+    def acknowledge(self, request, mfi, records):
+        """MFK response with a MFA segment per record"""
+        failed = len([r for r in records if r.status != SUCCESS])
+        segments = [mfi]
+        for record in records:
+            if record.status == SUCCESS:
+                status = record.status
+            else:
+                status = hl7.Field(SEP[1], [record.status, record.error])
+            segments.append(hl7.Segment(SEP[0], ['MFA', record.event,
+                record.control_id, responses.timestamp(), status,
+                record.key, value(record.mfe, 5)]))
+        if failed:
+            return responses.hl7ACK(request, 'AE', '%d of %d records failed' % (failed, len(records)),
+                message_type=self.message_type, extra_segments=segments)
+        return responses.hl7ACK(request, 'AA', message_type=self.message_type,
+            extra_segments=segments)
@@ -1,16 +1,447 @@
 """
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+Tests for hl7v2_django, run with "manage.py test hl7v2_django".
 
-Replace this with more appropriate tests for your application.
+MLLPServerTest runs the MLLP server in a thread on a loopback port and
+puts load on it, so that a drop in throughput fails the tests.
 """
 
-from django.test import TestCase
+import os
+import gzip
+import time
+import shutil
+import signal
+import logging
+import tempfile
+import socket
+import threading
 
+import hl7
+from cStringIO import StringIO
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
+from django.db import connections
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+
+from hl7v2_django import archive
+from hl7v2_django import tracing
+from hl7v2_django import responses
+from hl7v2_django.client import MLLPClient, ack_code, percentile
+from hl7v2_django.dispatch import Dispatcher, pattern
+from hl7v2_django.management.commands import runmllpyserver
+from hl7v2_django.management.commands import replayhl7archive
+from hl7v2_django.management.commands.mllpload import LoadClient
+
+
+# Dispatch config for the tests that load it from settings
+rules = [
+    pattern('^ADT', 'hl7v2_django.tests.fake_handler'),
+    pattern('^ZPI', 'hl7v2_django.tests.worker_pid'),
+]
+
+# MSH-10 of each message fake_handler has handled
+handled = []
+
+
+def fake_handler(request, *args, **kwargs):
+    """Stands in for the application's work, taking kwargs['latency'] seconds"""
+    handled.append(unicode(request['MSH'][0][9]))
+    cursor = connections['default'].cursor()
+    cursor.execute('SELECT 1')
+    time.sleep(kwargs.get('latency', 0))
+    return responses.hl7ACK(request, 'AA')
+
+
+def worker_pid(request, *args, **kwargs):
+    """ACK with the pid of the process that handled the message as MSA-3"""
+    return responses.hl7ACK(request, 'AA', str(os.getpid()))
+
+
+@override_settings(ROOT_HL7_DISPATCH_CONFIG='hl7v2_django.tests')
+class MLLPServerTestCase(TransactionTestCase):
+    """
+        Start the server on an ephemeral port, in this process, sharing
+        the test database, so tests can drive it with MLLP clients.
+        If archived is set the server archives to a temporary directory.
+    """
+    archived = False
+    handler_latency = 0.001     # seconds fake_handler takes
+
+    def setUp(self):
+        # Logging every frame at DEBUG would dominate the timings
+        self.logger = logging.getLogger('hl7v2_django')
+        self.log_level = self.logger.level
+        self.logger.setLevel(logging.INFO)
+
+        # The sqlite test database is in memory, so the server thread
+        # must use this thread's connection to see it
+        self.connection = connections['default']
+        self.connection.allow_thread_sharing = True
+
+        command = runmllpyserver.Command()
+        command.dispatcher = Dispatcher()
+        command.dispatcher.root = [pattern('^ADT', fake_handler,
+            {'latency': self.handler_latency})]
+        if self.archived:
+            self.root = tempfile.mkdtemp()
+            command.archive = archive.ArchiveWriter(self.root)
+        self.command = command
+        self.server = runmllpyserver.LLPServer([{'recv_addr': '127.0.0.1:0'}])
+        self.port = self.server.recv_sock[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, args=(command,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self, command):
+        connections['default'] = self.connection
+        self.server.dispatch(command.recv_handler, command.idle_handler)
+
+    def tearDown(self):
+        self.server.drain()
+        self.thread.join(10)
+        self.assertFalse(self.thread.is_alive(), 'Server did not drain')
+        self.server.close()
+        if self.archived:
+            shutil.rmtree(self.root)
+        self.connection.allow_thread_sharing = False
+        self.logger.setLevel(self.log_level)
+
+    def load(self, clients, messages, message_type='ADT^A01'):
+        """Run the clients to completion, return them and the elapsed time"""
+        load = [LoadClient(n, '127.0.0.1', self.port, messages, message_type, 1)
+            for n in range(clients)]
+        start = time.time()
+        for client in load:
+            client.start()
+        for client in load:
+            client.join(60)
+        return load, time.time() - start
+
+
+class MLLPServerTest(MLLPServerTestCase):
+    """
+        Drive the server with concurrent MLLP clients. The limits are
+        loose enough for a loaded build machine; they are there to catch
+        the server getting slower by multiples.
+    """
+    clients = 8
+    messages = 50           # per client
+    min_rate = 100          # messages/second
+    max_p50 = 0.05          # seconds
+    max_p99 = 0.5
+
+    def test_throughput(self):
+        load, elapsed = self.load(self.clients, self.messages)
+        latencies = sum([client.latencies for client in load], [])
+        total = self.clients * self.messages
+        self.assertEqual(sum([client.lost for client in load]), 0)
+        self.assertEqual(len(latencies), total)
+        self.assertEqual(sum([client.codes.get('AA', 0) for client in load]), total)
+
+        rate = total / elapsed
+        p50, p99 = percentile(latencies, 50), percentile(latencies, 99)
+        self.assertTrue(rate >= self.min_rate, '%.1f messages/second' % rate)
+        self.assertTrue(p50 <= self.max_p50, 'p50 %.1fms' % (p50 * 1000))
+        self.assertTrue(p99 <= self.max_p99, 'p99 %.1fms' % (p99 * 1000))
+
+    def test_unrouted_message(self):
+        load, elapsed = self.load(1, 3, 'ORU^R01')
+        self.assertEqual(load[0].codes, {'AE': 3})
+
+
+class ArchivedMLLPServerTest(MLLPServerTest):
+    """The same load and limits, with every frame archived"""
+    archived = True
+
+    def test_throughput(self):
+        super(ArchivedMLLPServerTest, self).test_throughput()
+        self.command.archive.flush()
+        entries = list(archive.Archive(self.root).query())
+        self.assertEqual(len(entries), 2 * self.clients * self.messages)
+
+
+class DrainTest(MLLPServerTestCase):
+    handler_latency = 0.2
+
+    def test_drain(self):
+        message = MSG % (0, 0)
+        idle = MLLPClient('127.0.0.1', self.port)
+        self.assertEqual(ack_code(idle.send(message)), 'AA')
+
+        busy = [MLLPClient('127.0.0.1', self.port) for i in range(3)]
+        for client in busy:
+            client.connect()
+        time.sleep(0.1)     # accepted; later connections belong to the next worker
+        # Each busy client has a message in flight when the drain starts
+        for i, client in enumerate(busy):
+            client.sock.sendall(runmllpyserver.LLP_SB + MSG % (i + 1, i)
+                + runmllpyserver.LLP_EB + runmllpyserver.CR)
+        time.sleep(0.05)
+        self.server.drain()
+        self.thread.join(10)
+        self.assertFalse(self.thread.is_alive(), 'Server did not drain')
+
+        # dispatch has returned: every in-flight message was answered,
+        # then every connection closed
+        for client in busy:
+            self.assertEqual(ack_code(client.receive()), 'AA')
+            self.assertEqual(client.sock.recv(1), '')
+        self.assertEqual(idle.sock.recv(1), '')
+
+        # and no new connections are served
+        late = MLLPClient('127.0.0.1', self.port, timeout=0.5)
+        self.assertRaises(socket.error, late.send, message)
+        for client in busy + [idle, late]:
+            client.close()
+
+
+class DrainIdleTest(MLLPServerTestCase):
+    handler_latency = 0.5
+
+    def test_frame_during_drain(self):
         """
-        Tests that 1 + 1 always equals 2.
+            A connection that has gone idle is served, not closed, if a
+            frame arrives on it while another connection is handled, so
+            the frame is not in the events of that poll.
         """
-        self.assertEqual(1 + 1, 2)
+        idle = MLLPClient('127.0.0.1', self.port)
+        self.assertEqual(ack_code(idle.send(MSG % (0, 0))), 'AA')
+        busy = MLLPClient('127.0.0.1', self.port)
+        busy.connect()
+        time.sleep(runmllpyserver.DRAIN_IDLE - 0.3)
+        self.server.drain()
+        # past the first poll of the drain, which allows only one close
+        time.sleep(0.15)
+        busy.sock.sendall(runmllpyserver.LLP_SB + MSG % (1, 1)
+            + runmllpyserver.LLP_EB + runmllpyserver.CR)
+        time.sleep(0.05)
+        # the busy connection's handler ends after idle has been idle for
+        # DRAIN_IDLE
+        idle.sock.sendall(runmllpyserver.LLP_SB + MSG % (2, 2)
+            + runmllpyserver.LLP_EB + runmllpyserver.CR)
+        self.thread.join(10)
+        self.assertFalse(self.thread.is_alive(), 'Server did not drain')
+
+        for client in [busy, idle]:
+            self.assertEqual(ack_code(client.receive()), 'AA')
+            self.assertEqual(client.sock.recv(1), '')
+            client.close()
+
+
+@override_settings(ROOT_HL7_DISPATCH_CONFIG='hl7v2_django.tests')
+class ReloadTest(TestCase):
+    """Run the supervisor in a child process and reload it"""
+
+    def setUp(self):
+        self.logger = logging.getLogger('hl7v2_django')
+        self.log_level = self.logger.level
+        self.logger.setLevel(logging.WARNING)
+        self.sock = runmllpyserver.LLPServer._mk_socket('127.0.0.1:0')
+        self.port = self.sock.getsockname()[1]
+        self.supervisor = os.fork()
+        if self.supervisor == 0:
+            status = 0
+            try:
+                runmllpyserver.Command().supervise([{'recv_addr': '127.0.0.1:0'}], [self.sock])
+            except:
+                logging.getLogger(__name__).exception('Supervisor failed')
+                status = 1
+            os._exit(status)
+
+    def tearDown(self):
+        try:
+            os.kill(self.supervisor, signal.SIGTERM)
+        except OSError:
+            pass
+        runmllpyserver.wait_for(self.supervisor)
+        self.sock.close()
+        self.logger.setLevel(self.log_level)
+
+    def worker(self):
+        """The pid of the worker serving a new connection"""
+        client = MLLPClient('127.0.0.1', self.port, timeout=10)
+        try:
+            response = hl7.parse(client.send(r'MSH|^~\&|LAB|HOSP|||20111201120000||ZPI^Z01|CTRL1|P|2.4'))
+        finally:
+            client.close()
+        self.assertEqual(unicode(response['MSA'][0][1]), 'AA')
+        return int(unicode(response['MSA'][0][3]))
+
+    def test_reload(self):
+        old = self.worker()
+        self.assertNotEqual(old, self.supervisor)
+        os.kill(self.supervisor, signal.SIGHUP)
+
+        # Connections keep being served on the same socket, by the old
+        # worker until the new one is ready, then by the new one
+        deadline = time.time() + 10
+        new = old
+        while new == old and time.time() < deadline:
+            new = self.worker()
+            time.sleep(0.05)
+        self.assertNotEqual(new, old)
+        self.assertNotEqual(new, self.supervisor)
+
+        # The old worker drains and exits, and is reaped by the supervisor
+        while time.time() < deadline:
+            try:
+                os.kill(old, 0)
+            except OSError:
+                break
+            time.sleep(0.1)
+        self.assertRaises(OSError, os.kill, old, 0)
+        self.assertEqual(self.worker(), new)
+
+
+MSG = '\r'.join([r"MSH|^~\&|LAB|HOSP|||20111201120000||ADT^A01|CTRL%d|P|2.4",
+    r"PID|1||PAT%d^^^HOSP~OTHER^^^X||Gill^Kevin"]) + '\r'
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_index_fields(self):
+        self.assertEqual(archive.index_fields(MSG % (1, 2)),
+            ('LAB', 'ADT^A01', 'CTRL1', 'PAT2'))
+        self.assertEqual(archive.index_fields('garbage'), ('', '', '', ''))
+
+    def test_batched_write_and_query(self):
+        writer = archive.ArchiveWriter(self.root, batch_size=3, flush_interval=60)
+        now = 1322740800.0
+        for i in range(4):
+            writer.record(archive.INBOUND, MSG % (i, i % 2), now + i)
+        # First batch written, last frame still buffered
+        store = archive.Archive(self.root)
+        self.assertEqual(len(list(store.query())), 3)
+        writer.flush_if_due()
+        self.assertEqual(len(list(store.query())), 3)
+        writer.flush()
+        self.assertEqual(len(list(store.query())), 4)
+
+        entries = list(store.query(patient_id='PAT1'))
+        self.assertEqual([e.control_id for e in entries], ['CTRL1', 'CTRL3'])
+        self.assertEqual(store.read(entries[1]), MSG % (3, 1))
+        self.assertEqual([e.control_id for e in store.query(start=now + 1, end=now + 2)],
+            ['CTRL1', 'CTRL2'])
+        self.assertEqual(list(store.query(direction=archive.OUTBOUND)), [])
+
+        # Each batch is a gzip member appended to the segment
+        day, hour = archive.partition(now)
+        segment = os.path.join(self.root, day, hour + archive.SEGMENT_SUFFIX)
+        self.assertEqual(gzip.open(segment).read(),
+            ''.join([MSG % (i, i % 2) + '\n' for i in range(4)]))
+
+    def test_partitions(self):
+        writer = archive.ArchiveWriter(self.root)
+        now = 1322740800.0
+        writer.record(archive.INBOUND, MSG % (1, 1), now)
+        writer.record(archive.OUTBOUND, MSG % (2, 1), now + 7200)
+        writer.flush()
+        store = archive.Archive(self.root)
+        self.assertEqual(len(list(store.partitions())), 2)
+        self.assertEqual(list(store.partitions(end=now + 60)), [archive.partition(now)])
+        entries = list(store.query(start=now + 3600))
+        self.assertEqual([(e.direction, e.control_id) for e in entries],
+            [(archive.OUTBOUND, 'CTRL2')])
+        self.assertEqual(store.read(entries[0]), MSG % (2, 1))
+
+    def test_not_utf8(self):
+        writer = archive.ArchiveWriter(self.root)
+        latin1 = (MSG % (1, 1)).replace('Kevin', 'Caf\xe9').replace('LAB', 'L\xc9B')
+        writer.record(archive.INBOUND, latin1)
+        writer.record(archive.INBOUND, MSG % (2, 2))
+        writer.flush()
+        store = archive.Archive(self.root)
+        entries = list(store.query())
+        self.assertEqual([e.control_id for e in entries], ['CTRL1', 'CTRL2'])
+        self.assertEqual(entries[0].sender, u'L\ufffdB')
+        self.assertEqual(store.read(entries[0]), latin1)
+        self.assertEqual([e.control_id for e in store.query(patient_id='PAT2')], ['CTRL2'])
+
+    def test_parse_timestamp(self):
+        start = replayhl7archive.parse_timestamp('2011120112')
+        self.assertEqual(time.localtime(start)[:6], (2011, 12, 1, 12, 0, 0))
+        end = replayhl7archive.parse_timestamp('2011120112', end=True)
+        self.assertEqual(end, start + 3600 - 0.000001)
+        end = replayhl7archive.parse_timestamp('20111231', end=True)
+        self.assertEqual(time.localtime(end + 0.000001)[:6], (2012, 1, 1, 0, 0, 0))
+
+    def test_replay(self):
+        writer = archive.ArchiveWriter(self.root)
+        for i in range(3):
+            writer.record(archive.INBOUND, MSG % (i, i))
+            writer.record(archive.OUTBOUND, MSG % (i + 10, i))
+        writer.flush()
+        del handled[:]
+        out = StringIO()
+        with override_settings(HL7_ARCHIVE={'root': self.root},
+                ROOT_HL7_DISPATCH_CONFIG='hl7v2_django.tests'):
+            call_command('replayhl7archive', rate=0, stdout=out)
+            self.assertEqual(handled, ['CTRL0', 'CTRL1', 'CTRL2'])
+            self.assertTrue(out.getvalue().endswith('3 messages replayed\n'))
+            self.assertEqual(out.getvalue().count(' -> AA '), 3)
+
+            del handled[:]
+            call_command('replayhl7archive', rate=0, control_id='CTRL1', stdout=out)
+            self.assertEqual(handled, ['CTRL1'])
+
+
+class TracingTest(TestCase):
+    def test_trace(self):
+        tracing.mark('read')    # no trace, ignored
+        tracer = tracing.Tracer(slow_threshold=0)
+        tracer.begin()
+        tracing.mark('read')
+        tracing.annotate(hl7.parse(MSG % (1, 1)))
+        tracing.mark('parse')
+        trace = tracer.end()
+        self.assertEqual([name for name, elapsed in trace.marks], ['read', 'parse'])
+        self.assertTrue(str(trace).startswith('ADT^A01 CTRL1 '))
+        self.assertEqual(tracer.end(), None)
+
+        # A short MSH is not an error for tracing
+        tracer.begin()
+        tracing.annotate(hl7.parse('MSH|^~\\&|LAB\r'))
+        self.assertEqual(tracer.end().message_type, '')
+
+    def test_profiler(self):
+        directory = tempfile.mkdtemp()
+        try:
+            profiler = tracing.Profiler(0, directory)
+            profiler.poll()
+            self.assertEqual(profiler.profile, None)
+            self.assertEqual(profiler.remaining(), None)
+            profiler.request()
+            profiler.poll()     # starts
+            self.assertEqual(profiler.remaining(), 0)
+            profiler.poll()     # duration passed, dumps
+            self.assertEqual(profiler.profile, None)
+            self.assertEqual(len(os.listdir(directory)), 1)
+        finally:
+            shutil.rmtree(directory)
+
+
+class ProfilerServerTest(MLLPServerTestCase):
+    def test_profile_stops_on_time(self):
+        directory = tempfile.mkdtemp()
+        try:
+            profiler = self.command.profiler = tracing.Profiler(0.5, directory)
+            profiler.request()
+            # A message wakes the server, which starts the profile; then
+            # the server is idle
+            client = MLLPClient('127.0.0.1', self.port)
+            self.assertEqual(ack_code(client.send(MSG % (1, 1))), 'AA')
+            client.close()
+            started = time.time()
+            while not os.listdir(directory) and time.time() - started < 3:
+                time.sleep(0.05)
+            # well within the 5 second poll delay of an idle server
+            self.assertEqual(len(os.listdir(directory)), 1)
+            self.assertTrue(time.time() - started < 1.5)
+            self.assertEqual(profiler.profile, None)
+        finally:
+            shutil.rmtree(directory)
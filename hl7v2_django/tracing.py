@@ -0,0 +1,146 @@
+"""
+    tracing.py
+
+    Timing of the message path, for finding where the time goes when
+    throughput drops.
+
+    A Trace is a timeline of marks. mark(name) records the time since the
+    previous mark, so the phases of handling a message are:
+
+        read        _read_frame
+        parse       hl7.parse
+        route       Dispatcher.dispatch finding the pattern
+        handler     pattern.callback running the view
+        commit      the transaction commit
+        serialize   encoding the response
+        write       _write_frame
+
+    Tracing is off unless a Tracer is given to the server. When it is off
+    mark() is a single test, so the calls can stay in the message path.
+
+    Profiler runs cProfile for a fixed time on request and writes the
+    aggregate stats to a file and the log.
+"""
+
+import os
+import time
+import pstats
+import logging
+import cProfile
+import tempfile
+from cStringIO import StringIO
+
+logger = logging.getLogger(__name__)
+
+# The trace of the message being handled, if tracing. The server handles
+# one message at a time, so this does not need to be thread local.
+_current = None
+
+
+def mark(name):
+    """Record the end of a phase in the current trace"""
+    if _current is not None:
+        _current.mark(name)
+
+
+def annotate(message):
+    """Identify the message being traced by its MSH-9 and MSH-10"""
+    if _current is not None:
+        try:
+            msh = message['MSH'][0]
+            _current.message_type = unicode(msh[8])
+            _current.control_id = unicode(msh[9])
+        except (KeyError, IndexError):
+            pass
+
+
+class Trace(object):
+    def __init__(self):
+        self.start = self.last = time.time()
+        self.marks = []
+        self.message_type = ''
+        self.control_id = ''
+
+    def mark(self, name):
+        now = time.time()
+        self.marks.append((name, now - self.last))
+        self.last = now
+
+    def total(self):
+        return self.last - self.start
+
+    def __str__(self):
+        return '%s %s %.1fms: %s' % (self.message_type, self.control_id,
+            self.total() * 1000, ', '.join(['%s %.1fms' % (name, elapsed * 1000)
+                for name, elapsed in self.marks]))
+
+
+class Tracer(object):
+    """
+        Trace each message, log those taking longer than slow_threshold
+        seconds with their timing breakdown.
+    """
+
+    def __init__(self, slow_threshold):
+        self.slow_threshold = slow_threshold
+
+    def begin(self):
+        global _current
+        _current = Trace()
+
+    def end(self):
+        global _current
+        trace, _current = _current, None
+        if trace is not None and trace.message_type and trace.total() >= self.slow_threshold:
+            logger.warning('Slow message %s', trace)
+        return trace
+
+
+class Profiler(object):
+    """
+        Profile the process for duration seconds when requested, then
+        dump the stats. request() may be called from a signal handler;
+        the profiler is started and stopped by poll(), which the server
+        calls every time it wakes up. While profiling, the server wakes up
+        within remaining() seconds, so the profile stops on time.
+    """
+
+    def __init__(self, duration, directory=None, limit=30):
+        self.duration = duration
+        self.directory = directory or tempfile.gettempdir()
+        self.limit = limit
+        self.requested = False
+        self.profile = None
+        self.started = None
+
+    def request(self):
+        self.requested = True
+
+    def poll(self):
+        if self.profile is None:
+            if self.requested:
+                self.requested = False
+                logger.info('Profiling for %s seconds', self.duration)
+                self.started = time.time()
+                self.profile = cProfile.Profile()
+                self.profile.enable()
+        elif time.time() - self.started >= self.duration:
+            self.profile.disable()
+            profile, self.profile = self.profile, None
+            self.dump(profile)
+
+    def remaining(self):
+        """Seconds until the running profile is due to stop, None if not running"""
+        if self.profile is None:
+            return None
+        return max(0, self.started + self.duration - time.time())
+
+    def dump(self, profile):
+        path = os.path.join(self.directory, 'mllp-%d-%s.prof' % (os.getpid(),
+            time.strftime('%Y%m%d%H%M%S', time.localtime(self.started))))
+        profile.dump_stats(path)
+        out = StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(self.limit)
+        logger.info('Profile written to %s\n%s', path, out.getvalue())
+        return path
@@ -2,16 +2,70 @@
     Master File Notification messages (Chapter 8)
 """
 
-from hl7v2_django import responses
+import datetime
 
-def m02(request, *args, **kwargs):  # practitioner
-    import pdb; pdb.set_trace()
+from hl7v2_django import mfn
+from hl7v2_django.mfn import value
+
+from sd.models import Staff, Practitioner
+
+
+def staff_fields(stf):
+    """Model field values from a STF segment, common to staff and practitioners"""
+    return {
+        'family_name': value(stf, 3, 0),
+        'given_name': value(stf, 3, 1),
+        'staff_type': value(stf, 4),
+        'active': value(stf, 7) != 'I',
+    }
+
+
+def date_of_birth(stf):
+    """STF-6 as a date, None if not given"""
+    date_of_birth = value(stf, 6)[:8]
+    if not date_of_birth:
+        return None
+    try:
+        return datetime.datetime.strptime(date_of_birth, '%Y%m%d').date()
+    except ValueError:
+        raise ValueError('Invalid date of birth (STF-6) %s' % date_of_birth)
+
+
+class StaffFile(mfn.MasterFile):
+    model = Staff
+    message_type = ['MFK', 'M05']
 
-    resp = responses.hl7ACK(request, 'AA')
-    return resp
+    def fields(self, record):
+        stf = record.segment('STF')
+        if stf is None:
+            raise ValueError('No STF segment')
+        values = staff_fields(stf)
+        values['sex'] = value(stf, 5)[:1]
+        values['date_of_birth'] = date_of_birth(stf)
+        return values
 
-def m05(request, *args, **kwargs):  # location
-    import pdb; pdb.set_trace()
 
-    resp = responses.hl7ACK(request, 'AA')
-    return resp
+class PractitionerFile(mfn.MasterFile):
+    model = Practitioner
+    message_type = ['MFK', 'M02']
+
+    def fields(self, record):
+        stf = record.segment('STF')
+        if stf is None:
+            raise ValueError('No STF segment')
+        values = staff_fields(stf)
+        pra = record.segment('PRA')
+        values['practitioner_group'] = pra and value(pra, 2) or u''
+        values['practitioner_category'] = pra and value(pra, 3) or u''
+        return values
+
+
+staff = StaffFile()
+practitioners = PractitionerFile()
+
+
+def m02(request, *args, **kwargs):  # practitioner
+    return practitioners.process(request)
+
+def m05(request, *args, **kwargs):  # staff
+    return staff.process(request)
@@ -1,3 +1,29 @@
 from django.db import models
 
-# Create your models here.
+
+class Staff(models.Model):
+    """Staff master file, maintained by MFN^M05 messages"""
+    key = models.CharField(max_length=60, unique=True)     # MFE-4
+    family_name = models.CharField(max_length=100, blank=True)
+    given_name = models.CharField(max_length=100, blank=True)
+    staff_type = models.CharField(max_length=20, blank=True)
+    sex = models.CharField(max_length=1, blank=True)
+    date_of_birth = models.DateField(null=True, blank=True)
+    active = models.BooleanField(default=True)
+
+    def __unicode__(self):
+        return u'%s %s (%s)' % (self.given_name, self.family_name, self.key)
+
+
+class Practitioner(models.Model):
+    """Practitioner master file, maintained by MFN^M02 messages"""
+    key = models.CharField(max_length=60, unique=True)     # MFE-4
+    family_name = models.CharField(max_length=100, blank=True)
+    given_name = models.CharField(max_length=100, blank=True)
+    staff_type = models.CharField(max_length=20, blank=True)
+    active = models.BooleanField(default=True)
+    practitioner_group = models.CharField(max_length=60, blank=True)
+    practitioner_category = models.CharField(max_length=20, blank=True)
+
+    def __unicode__(self):
+        return u'%s %s (%s)' % (self.given_name, self.family_name, self.key)
@@ -5,8 +5,15 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import datetime
+
+import hl7
+
 from django.test import TestCase
 
+from sd import mfn_handlers
+from sd.models import Staff, Practitioner
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +21,113 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+def mfn_message(message_type, *records):
+    segments = [r"MSH|^~\&|HIS|HOSP|||20111201120000||%s|CTRL1|P|2.4" % message_type,
+        r"MFI|STF||UPD|||AL"]
+    for record in records:
+        segments.extend(record)
+    return hl7.parse('\r'.join(segments) + '\r')
+
+
+def mfa(response):
+    return [(unicode(s[1]), unicode(s[4]), unicode(s[5])) for s in response.segments('MFA')]
+
+
+def process(handler, request):
+    """Run a handler, return its response as the sender would parse it"""
+    return hl7.parse(unicode(handler(request)))
+
+
+class MFNTest(TestCase):
+    def test_staff(self):
+        request = mfn_message('MFN^M05',
+            [r"MFE|MAD|1|20111201|S1|CE", r"STF|S1||Gill^Kevin||M|19660429|A"],
+            [r"MFE|MAD|2|20111201|S2|CE", r"STF|S2||Smith^Jane||F||A"],
+            [r"MFE|MAD|3|20111201|S3|CE", r"STF|S3||Bad^Date||F|1966XX29|A"],
+            [r"MFE|MXX|4|20111201|S4|CE"])
+        response = process(mfn_handlers.m05, request)
+        self.assertEqual(unicode(response['MSH'][0][8]), 'MFK^M05')
+        self.assertEqual(unicode(response['MSA'][0][1]), 'AE')
+        self.assertEqual(mfa(response), [('MAD', 'S', 'S1'), ('MAD', 'S', 'S2'),
+            ('MAD', 'U^Invalid date of birth (STF-6) 1966XX29', 'S3'),
+            ('MXX', 'U^Unknown event MXX', 'S4')])
+        gill = Staff.objects.get(key='S1')
+        self.assertEqual((gill.family_name, gill.given_name, gill.date_of_birth, gill.active),
+            ('Gill', 'Kevin', datetime.date(1966, 4, 29), True))
+        self.assertEqual(Staff.objects.count(), 2)
+
+        request = mfn_message('MFN^M05',
+            [r"MFE|MUP|5|20111202|S1|CE", r"STF|S1||Gill^Kevin||M|19660429|I"],
+            [r"MFE|MUP|6|20111202|S2|CE", r"STF|S2||Smith^Jane||F||A"],
+            [r"MFE|MDL|7|20111202|S2|CE"])
+        response = process(mfn_handlers.m05, request)
+        self.assertEqual(unicode(response['MSA'][0][1]), 'AA')
+        self.assertEqual(mfa(response), [('MUP', 'S', 'S1'), ('MUP', 'S', 'S2'),
+            ('MDL', 'S', 'S2')])
+        self.assertEqual(list(Staff.objects.values_list('key', 'active')), [('S1', False)])
+
+    def test_unchanged_records_skipped(self):
+        records = [[r"MFE|MAD|%d|20111201|P%d|CE" % (i, i),
+            r"STF|P%d||Doctor^%d|MD|||A" % (i, i), r"PRA|P%d|GP|I" % i] for i in range(50)]
+        with self.assertNumQueries(2):  # index, bulk insert
+            mfn_handlers.m02(mfn_message('MFN^M02', *records))
+        self.assertEqual(Practitioner.objects.count(), 50)
+        self.assertEqual(Practitioner.objects.get(key='P7').practitioner_group, 'GP')
+
+        records[7][1] = r"STF|P7||Doctor^Seven|MD|||A"
+        with self.assertNumQueries(2):  # index, one update
+            response = process(mfn_handlers.m02, mfn_message('MFN^M02', *records))
+        self.assertEqual(len(mfa(response)), 50)
+        self.assertEqual(Practitioner.objects.get(key='P7').given_name, 'Seven')
+
+        # Every row changed: index, then updates in chunks of 38 rows
+        records = [[r"MFE|MUP|%d|20111201|P%d|CE" % (i, i),
+            r"STF|P%d||Doctor^Changed%d|MD|||A" % (i, i), r"PRA|P%d|GP|I" % i] for i in range(50)]
+        with self.assertNumQueries(3):
+            mfn_handlers.m02(mfn_message('MFN^M02', *records))
+        self.assertEqual(sorted(Practitioner.objects.values_list('given_name', flat=True)),
+            sorted(['Changed%d' % i for i in range(50)]))
+
+    def test_deactivate_reactivate(self):
+        mfn_handlers.m05(mfn_message('MFN^M05',
+            [r"MFE|MAD|1|20111201|S1|CE", r"STF|S1||Gill^Kevin||M|19660429|A"],
+            [r"MFE|MAD|2|20111201|S2|CE", r"STF|S2||Smith^Jane||F||I"]))
+
+        # MDC/MAC set the active flag by key, with or without STF
+        response = process(mfn_handlers.m05, mfn_message('MFN^M05',
+            [r"MFE|MDC|3|20111202|S1|CE"],
+            [r"MFE|MAC|4|20111202|S2|CE", r"STF|S2||Smith^Jane||F||I"],
+            [r"MFE|MDC|5|20111202|S9|CE"],
+            [r"MFE|MDL|6|20111202|S8|CE"]))
+        self.assertEqual(mfa(response), [('MDC', 'S', 'S1'), ('MAC', 'S', 'S2'),
+            ('MDC', 'U^No record with key S9', 'S9'),
+            ('MDL', 'U^No record with key S8', 'S8')])
+        self.assertEqual(list(Staff.objects.order_by('key').values_list('key', 'active')),
+            [('S1', False), ('S2', True)])
+        # other fields are untouched
+        self.assertEqual(Staff.objects.get(key='S1').given_name, 'Kevin')
+
+        # Added and deactivated in the same message
+        response = process(mfn_handlers.m05, mfn_message('MFN^M05',
+            [r"MFE|MAD|6|20111203|S3|CE", r"STF|S3||New^Staff||F||A"],
+            [r"MFE|MDC|7|20111203|S3|CE"]))
+        self.assertEqual(unicode(response['MSA'][0][1]), 'AA')
+        self.assertEqual(Staff.objects.get(key='S3').active, False)
+
+        # Added and deleted in the same message: nothing to delete
+        response = process(mfn_handlers.m05, mfn_message('MFN^M05',
+            [r"MFE|MAD|8|20111203|S4|CE", r"STF|S4||New^Staff||F||A"],
+            [r"MFE|MDL|9|20111203|S4|CE"]))
+        self.assertEqual(mfa(response), [('MAD', 'S', 'S4'), ('MDL', 'S', 'S4')])
+        self.assertFalse(Staff.objects.filter(key='S4').exists())
+
+    def test_practitioner_date_of_birth_ignored(self):
+        # Practitioner has no date of birth, so STF-6 is not parsed
+        response = process(mfn_handlers.m02, mfn_message('MFN^M02',
+            [r"MFE|MAD|1|20111201|P1|CE", r"STF|P1||Doctor^One|MD|M|1966XX29|A",
+                r"PRA|P1|GP|I"]))
+        self.assertEqual(unicode(response['MSA'][0][1]), 'AA')
+        self.assertEqual(mfa(response), [('MAD', 'S', 'P1')])
+        self.assertEqual(Practitioner.objects.get(key='P1').given_name, 'One')
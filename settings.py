@@ -120,6 +120,7 @@ INSTALLED_APPS = (
     # Uncomment the next line to enable admin documentation:
     # 'django.contrib.admindocs',
     'hl7v2_django',
+    'sd',
 )
 
 # A sample logging configuration. The only tangible logging
@@ -177,6 +178,25 @@ MLLP_SOCKETS = [
     },
 ]
 
+# Seconds a worker has to finish its connections when reloading or stopping.
+MLLP_DRAIN_TIMEOUT = 30
+
 # This should be similar to the URL concept in Django for
 # dispatching request messages.
 ROOT_HL7_DISPATCH_CONFIG = 'sd_hl7.hl7_dispatch_config'
+
+# Archive of the raw frames sent and received by runmllpyserver, used for
+# audit lookups and replayhl7archive. None disables archiving.
+# HL7_ARCHIVE = {
+#     'root': '/var/lib/sd_hl7/archive',
+#     'batch_size': 100,          # frames per write
+#     'flush_interval': 1.0,      # max seconds a frame is buffered
+# }
+HL7_ARCHIVE = None
+
+# Log a timing breakdown of each message taking longer than this many
+# seconds to handle (runmllpyserver --slow). None disables tracing.
+HL7_SLOW_MESSAGE_THRESHOLD = None
+
+# Where runmllpyserver --profile writes its stats, default the temp directory.
+# HL7_PROFILE_DIR = '/tmp'